@@ -1,7 +1,8 @@
-from distutils.core import setup
+from setuptools import setup
 
 setup(name='traildb',
       version='0.0.1',
       description='TrailDB stores and queries cookie trails from raw logs.',
       author='AdRoll.com',
-      packages=['traildb'])
+      packages=['traildb'],
+      extras_require={'numpy': ['numpy']})
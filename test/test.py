@@ -3,9 +3,19 @@ import shutil
 import subprocess
 import unittest
 import datetime
+import io
+import sys
 
 from traildb import TrailDB, TrailDBConstructor, tdb_item_field, tdb_item_val
 from traildb import TrailDBError, TrailDBCursor
+from traildb import HyperLogLog, SpaceSaving
+from traildb import TrailDBCollection
+from traildb.__main__ import main as cli_main
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class TestAPI(unittest.TestCase):
     def setUp(self):
@@ -89,6 +99,172 @@ class TestAPI(unittest.TestCase):
         self.assertEqual((1, 3), db.time_range(parsetime = False))
 
 
+def count_events(db):
+    return db.num_events
+
+def unpicklable_on_b(db):
+    if db.path.endswith('b.tdb'):
+        return lambda: None
+    return db.num_events
+
+def fail_on_b(db):
+    if db.path.endswith('b.tdb'):
+        raise ValueError('broken shard')
+    return db.num_events
+
+
+class TestCollection(unittest.TestCase):
+    def setUp(self):
+        os.mkdir('testshards')
+        uuid = '12345678123456781234567812345678'
+        for name, tstamps, fields in [('a', [1, 2], ['field1']),
+                                      ('b', [10, 11, 12], ['field1']),
+                                      ('c', [20], ['field2'])]:
+            cons = TrailDBConstructor('testshards/' + name, fields)
+            for tstamp in tstamps:
+                cons.add(uuid, tstamp, ['x'])
+            cons.finalize()
+
+    def tearDown(self):
+        shutil.rmtree('testshards')
+
+    def test_metadata(self):
+        shards = TrailDBCollection('testshards/*.tdb')
+        self.assertEqual(3, len(shards))
+        self.assertEqual(3, shards.num_trails)
+        self.assertEqual(6, shards.num_events)
+        self.assertEqual((1, 20), shards.time_range())
+        self.assertEqual((10, 12), shards.shards[1].time_range)
+        self.assertEqual(('time', 'field1'), shards.shards[0].fields)
+
+    def test_select(self):
+        shards = TrailDBCollection('testshards/*.tdb')
+        self.assertEqual(['testshards/b.tdb', 'testshards/c.tdb'],
+                         [s.path for s in shards.select(start=5)])
+        self.assertEqual(['testshards/a.tdb'],
+                         [s.path for s in shards.select(end=5)])
+        self.assertEqual(['testshards/c.tdb'],
+                         [s.path for s in shards.select(fields=['field2'])])
+
+    def test_query(self):
+        shards = TrailDBCollection('testshards/*.tdb')
+        res = shards.query(count_events, lambda a, b: a + b, 0, processes=2)
+        self.assertEqual(6, res.result)
+        self.assertEqual([], res.failures)
+
+        res = shards.query(count_events, start=10, processes=1)
+        self.assertEqual({'testshards/b.tdb': 3, 'testshards/c.tdb': 1},
+                         res.result)
+
+        seen = []
+        res = shards.query(fail_on_b, lambda a, b: a + b, 0, processes=1,
+                           progress=lambda *args: seen.append(args))
+        self.assertEqual(3, res.result)
+        self.assertEqual(['testshards/b.tdb'], [path for path, _ in res.failures])
+        self.assertEqual([1, 2, 3], [done for _, done, _, _ in seen])
+
+        res = shards.query(unpicklable_on_b, lambda a, b: a + b, 0, processes=2)
+        self.assertEqual(3, res.result)
+        self.assertEqual(['testshards/b.tdb'], [path for path, _ in res.failures])
+
+        res = shards.query(lambda db: 1, lambda a, b: a + b, 0, processes=2)
+        self.assertEqual(0, res.result)
+        self.assertEqual(3, len(res.failures))
+
+
+@unittest.skipIf(sys.version_info < (3,), 'the CLI requires Python 3')
+class TestCLI(unittest.TestCase):
+    def setUp(self):
+        cons = TrailDBConstructor('testtrail', ['field1', 'field2'])
+        for i in range(10):
+            uuid = '%032x' % (i + 1)
+            cons.add(uuid, i, ['a', str(i % 2)])
+            cons.add(uuid, i + 100, ['b', ''])
+        cons.finalize()
+
+    def tearDown(self):
+        for path in ('testtrail.tdb', 'testtrail2.tdb'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def run_cli(self, *argv, **kwds):
+        status = kwds.get('status', 0)
+        stdout = sys.stdout
+        sys.stdout = out = io.StringIO()
+        try:
+            self.assertEqual(status, cli_main(list(argv)))
+        finally:
+            sys.stdout = stdout
+        return out.getvalue().splitlines()
+
+    def test_info(self):
+        lines = self.run_cli('info', 'testtrail.tdb')
+        self.assertIn('trails: 10', lines)
+        self.assertIn('events: 20', lines)
+        self.assertIn('field field1: 2 values', lines)
+
+    def test_dump(self):
+        lines = self.run_cli('dump', 'testtrail.tdb', '--fields', 'field2',
+                             '--end', '50')
+        self.assertEqual('uuid,time,field2', lines[0])
+        self.assertEqual(11, len(lines))
+        self.assertEqual(lines, self.run_cli('dump', 'testtrail.tdb',
+                                             '--fields', 'field2', '--end', '50',
+                                             '--workers', '2'))
+
+    def test_count_top(self):
+        self.assertEqual(['trails: 5', 'events: 5'],
+                         self.run_cli('count', 'testtrail.tdb', '--field',
+                                      'field2', '--value', '1', '--workers', '2'))
+        self.assertEqual(['a\t10', 'b\t10'],
+                         sorted(self.run_cli('top', 'testtrail.tdb', 'field1')))
+        self.assertEqual(['0\t1'],
+                         self.run_cli('top', 'testtrail.tdb', 'field2', '-k', '1',
+                                      '--start', '0', '--end', '0'))
+
+    def test_errors(self):
+        self.run_cli('dump', 'testtrail.tdb', '--fields', 'time', status=1)
+        self.run_cli('count', 'testtrail.tdb', '--field', 'field1', status=1)
+        with self.assertRaises(SystemExit):
+            self.run_cli('info', 'testtrail.tdb', '--workers', '2')
+
+    def test_merge(self):
+        self.run_cli('merge', 'testtrail2', 'testtrail.tdb', 'testtrail.tdb')
+        self.assertEqual(40, TrailDB('testtrail2.tdb').num_events)
+
+
+class TestSketch(unittest.TestCase):
+    def test_hyperloglog(self):
+        a = HyperLogLog(12)
+        b = HyperLogLog(12)
+        for i in range(5000):
+            a.add(i)
+            b.add(i + 2500)
+        self.assertAlmostEqual(5000, a.estimate(), delta=250)
+        registers = bytearray(map(max, a.registers, b.registers))
+        a.merge(b)
+        self.assertEqual(registers, a.registers)
+        self.assertAlmostEqual(7500, a.estimate(), delta=375)
+        with self.assertRaises(ValueError):
+            a.merge(HyperLogLog(10))
+        self.assertEqual(1 << 18, len(HyperLogLog(18).registers))
+        with self.assertRaises(ValueError):
+            HyperLogLog(19)
+
+    def test_space_saving(self):
+        a = SpaceSaving(3)
+        for key in 'aaaaabbbcd':
+            a.add(key)
+        self.assertEqual(3, len(a))
+        self.assertEqual(('a', 5, 0), a.top(1)[0])
+
+        b = SpaceSaving(3)
+        b.update({'b': 4, 'e': 1})
+        a.merge(b)
+        self.assertEqual(['b', 'a'], [key for key, _, _ in a.top(2)])
+        self.assertEqual(3, len(a))
+
+
 class TestCons(unittest.TestCase):
     def test_cursor(self):
         uuid = '12345678123456781234567812345678'
@@ -137,6 +313,50 @@ class TestCons(unittest.TestCase):
         self.assertEquals(tdb.time_range(True),
                           (events[0][0], events[-1][0]))
 
+    def test_cursor_parsetime_same_second(self):
+        uuid = '12345678123456781234567812345678'
+        cons = TrailDBConstructor('testtrail', ['field1'])
+        for tstamp, value in [(10, 'a'), (10, 'b'), (11, 'c'), (11, 'd')]:
+            cons.add(uuid, tstamp, [value])
+        tdb = cons.finalize()
+
+        events = list(tdb.trail(0, parsetime=True))
+        self.assertEqual([datetime.datetime.fromtimestamp(t) for t in (10, 10, 11, 11)],
+                         [e.time for e in events])
+
+    def test_cursor_parsetime_utc(self):
+        uuid = '12345678123456781234567812345678'
+        utc = datetime.timezone.utc
+        cons = TrailDBConstructor('testtrail', ['field1'], tz=utc)
+        cons.add(uuid, datetime.datetime(2016, 1, 1, 0, 0, 1), ['1'])
+        cons.add(uuid, datetime.datetime(2016, 1, 1, 23, 59, 59, tzinfo=utc), ['2'])
+        cons.add(uuid, datetime.datetime(2016, 1, 2, 0, 0, 0), ['3'])
+        tdb = cons.finalize()
+
+        self.assertEqual([1451606401, 1451692799, 1451692800],
+                         list(tdb.trail_timestamps(0)))
+        timestamps = [e.time for e in tdb.trail(0, parsetime=True, tz=utc)]
+        self.assertEqual([datetime.datetime(2016, 1, 1, 0, 0, 1, tzinfo=utc),
+                          datetime.datetime(2016, 1, 1, 23, 59, 59, tzinfo=utc),
+                          datetime.datetime(2016, 1, 2, 0, 0, 0, tzinfo=utc)],
+                         timestamps)
+        self.assertEqual((timestamps[0], timestamps[-1]),
+                         tdb.time_range(parsetime=True, tz=utc))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_trail_timestamps_datetime64(self):
+        uuid = '12345678123456781234567812345678'
+        cons = TrailDBConstructor('testtrail', ['field1'])
+        cons.add(uuid, 1451606401, ['1'])
+        cons.add(uuid, 1451692800, ['2'])
+        tdb = cons.finalize()
+
+        tstamps = tdb.trail_timestamps(0, datetime64=True)
+        self.assertEqual(numpy.dtype('datetime64[s]'), tstamps.dtype)
+        self.assertEqual([numpy.datetime64('2016-01-01T00:00:01'),
+                          numpy.datetime64('2016-01-02T00:00:00')],
+                         list(tstamps))
+
     def test_binarydata(self):
         binary = '\x00\x01\x02\x00\xff\x00\xff'
         uuid = '12345678123456781234567812345678'
@@ -229,6 +449,58 @@ class TestCons(unittest.TestCase):
         self.assertEqual([123, 124], [e.time for e in trail])
         self.assertEqual(['foobarbaz', 'barquuxmoo'], [e.field1 for e in trail])
 
+    def test_trail_lengths(self):
+        cons = TrailDBConstructor('testtrail', ['field1'])
+        sizes = [5, 1, 1, 1, 1, 1]
+        for i, size in enumerate(sizes):
+            uuid = '%032x' % (i + 1)
+            for j in range(size):
+                cons.add(uuid, j, [str(j)])
+        tdb = cons.finalize()
+
+        lengths = tdb.trail_lengths()
+        self.assertEqual(sum(sizes), sum(lengths))
+        self.assertEqual(sorted(sizes), sorted(lengths))
+        for i in range(tdb.num_trails):
+            self.assertEqual(lengths[i], len(list(tdb.trail(i))))
+        self.assertIs(lengths, tdb.trail_lengths())
+
+        chunks = tdb.partition(2)
+        self.assertEqual(2, len(chunks))
+        self.assertEqual(0, chunks[0][0])
+        self.assertEqual(tdb.num_trails, chunks[-1][1])
+        self.assertEqual(chunks[0][1], chunks[1][0])
+
+        self.assertEqual([(0, tdb.num_trails)], tdb.partition(1))
+        self.assertEqual(tdb.num_trails, len(tdb.partition(100)))
+        with self.assertRaises(ValueError):
+            tdb.partition(0)
+
+    def test_approx_aggregations(self):
+        cons = TrailDBConstructor('testtrail', ['field1'])
+        for i in range(20):
+            uuid = '%032x' % (i + 1)
+            cons.add(uuid, 1, ['common'])
+            cons.add(uuid, 2, ['common'])
+            if i % 4 == 0:
+                cons.add(uuid, 3, ['rare'])
+        tdb = cons.finalize()
+
+        distinct = tdb.approx_distinct('field1')
+        self.assertEqual(20, len(distinct[b'common']))
+        self.assertEqual(5, len(distinct[b'rare']))
+        self.assertEqual(distinct[b'common'].registers,
+                         tdb.approx_distinct('field1', processes=2)[b'common'].registers)
+        with self.assertRaises(TrailDBError):
+            tdb.approx_distinct('field1', memory=100)
+        with self.assertRaises(TrailDBError):
+            tdb.approx_distinct('field1', precision=18, memory=1 << 16)
+
+        top = tdb.approx_top_k('field1', 1)
+        self.assertEqual([(b'common', 40, 0)], top)
+        self.assertEqual(tdb.approx_top_k('field1', 2),
+                         tdb.approx_top_k('field1', 2, processes=2))
+
     def tearDown(self):
         try:
             os.unlink('testtrail.tdb')
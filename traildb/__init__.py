@@ -1 +1,3 @@
 from .traildb import TrailDBError, TrailDBConstructor, TrailDB, TrailDBCursor, tdb_item_field, tdb_item_val
+from .sketch import HyperLogLog, SpaceSaving
+from .collection import TrailDBCollection, ShardInfo, QueryResult
@@ -1,5 +1,340 @@
+"""Command-line interface for inspecting TrailDBs.
+
+    python -m traildb info a.tdb
+    python -m traildb dump a.tdb --fields field1,field2 --format jsonl
+    python -m traildb count a.tdb --field field1 --value x --workers 8
+    python -m traildb top a.tdb field1 -k 20 --workers 8
+    python -m traildb merge out a.tdb b.tdb
+
+Requires Python 3.
+"""
+import argparse
+import csv
+import io
+import json
 import sys
-import traildb
+from calendar import timegm
+from collections import Counter
+from datetime import datetime
+from multiprocessing import Pool
+
+from traildb import TrailDB, TrailDBConstructor, TrailDBError
+from traildb.sketch import SpaceSaving, hash64
+from traildb.traildb import tdb_item_val, _imap_bounded
+
+# Number of chunks per worker: more chunks bound the memory used for
+# buffered output and smooth out uneven scan times.
+CHUNKS_PER_WORKER = 64
+
+TIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S')
+
+
+def text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def parse_time(value):
+    """Parse a Unix timestamp or a date (time) in UTC."""
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    for fmt in TIME_FORMATS:
+        try:
+            return timegm(datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("Invalid time: '%s'" % value)
+
+
+class Decoder(object):
+    """Decode raw items to strings, memoizing the decoded values."""
+
+    MAX_CACHE = 1 << 20
+
+    def __init__(self, db):
+        self.db = db
+        self.cache = {}
+
+    def __call__(self, item):
+        value = self.cache.get(item)
+        if value is None:
+            if len(self.cache) > self.MAX_CACHE:
+                self.cache.clear()
+            value = self.cache[item] = text(self.db.get_item_value(item))
+        return value
+
+
+def trail_ids(db, args, start, end):
+    """Iterate over Trail IDs in range(start, end), sampled by UUID."""
+    if args.sample >= 1.0:
+        return range(start, end)
+    threshold = int(args.sample * 2 ** 64)
+    return (i for i in range(start, end)
+            if hash64(db.get_uuid(i, raw=True)) < threshold)
+
+
+def events(db, args, i):
+    """Iterate over raw events of a trail within the time window."""
+    for event in db.trail(i, rawitems=True):
+        if args.start is not None and event[0] < args.start:
+            continue
+        if args.end is not None and event[0] > args.end:
+            break
+        yield event
+
+
+def _run_chunk(job):
+    fun, args, start, end = job
+    return fun(TrailDB(args.path), args, start, end)
+
+
+def scan(db, args, fun):
+    """Apply fun(db, args, start, end) to chunks of trails and iterate
+    over the results in Trail ID order, using args.workers processes."""
+    workers = max(1, args.workers)
+    if workers == 1:
+        # A single pass: partitioning would walk every trail first.
+        yield fun(db, args, 0, db.num_trails)
+        return
+    jobs = [(fun, args, start, end)
+            for start, end in db.partition(workers * CHUNKS_PER_WORKER)]
+    pool = Pool(workers)
+    try:
+        for result in _imap_bounded(pool, _run_chunk, jobs, 2 * workers):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def field_names(db):
+    return list(db.fields)
+
+
+def resolve_field(db, name):
+    """Return the field ID of a field name. The time field is rejected:
+    its events hold timestamps, not items."""
+    names = field_names(db)
+    if name == names[0]:
+        raise TrailDBError("Field '%s' holds timestamps, not values" % name)
+    try:
+        return names.index(name)
+    except ValueError:
+        raise TrailDBError("No such field: '%s'" % name)
+
+
+# info
+
+def cmd_info(db, args):
+    tmin, tmax = db.time_range()
+    print('path: %s' % args.path)
+    print('trails: %d' % db.num_trails)
+    print('events: %d' % db.num_events)
+    print('fields: %d' % db.num_fields)
+    print('time range: %d - %d (%s - %s UTC)' % (
+        tmin, tmax,
+        datetime.utcfromtimestamp(tmin).isoformat(),
+        datetime.utcfromtimestamp(tmax).isoformat()))
+    for field, name in enumerate(field_names(db)[1:], 1):
+        print('field %s: %d values' % (name, db.lexicon_size(field) - 1))
+
+
+# dump
+
+def dump_rows(db, args, start, end, out):
+    """Write events of trails in range(start, end) to a text stream."""
+    decode = Decoder(db)
+    names = ['uuid', 'time'] + args.field_names
+    writer = csv.writer(out, lineterminator='\n')
+    for i in trail_ids(db, args, start, end):
+        uuid = db.get_uuid(i)
+        for event in events(db, args, i):
+            row = [uuid, event[0]] + [decode(event[f]) for f in args.field_ids]
+            if args.format == 'csv':
+                writer.writerow(row)
+            else:
+                out.write(json.dumps(dict(zip(names, row))))
+                out.write('\n')
+
+
+def dump_chunk(db, args, start, end):
+    out = io.StringIO()
+    dump_rows(db, args, start, end, out)
+    return out.getvalue()
+
+
+def cmd_dump(db, args):
+    names = field_names(db)[1:]
+    if args.fields:
+        names = args.fields.split(',')
+    args.field_names = names
+    args.field_ids = [resolve_field(db, name) for name in names]
+    out = sys.stdout
+    if args.format == 'csv':
+        csv.writer(out, lineterminator='\n').writerow(['uuid', 'time'] + names)
+    if args.workers <= 1:
+        # Stream straight to the output instead of buffering a chunk.
+        dump_rows(db, args, 0, db.num_trails, out)
+        return
+    for chunk in scan(db, args, dump_chunk):
+        out.write(chunk)
+
+
+# count
+
+def count_chunk(db, args, start, end):
+    num_trails = num_events = 0
+    for i in trail_ids(db, args, start, end):
+        if args.item is None:
+            n = sum(1 for _ in events(db, args, i))
+        else:
+            n = sum(1 for event in events(db, args, i)
+                    if event[args.field_id] == args.item)
+        num_events += n
+        num_trails += 1 if n else 0
+    return num_trails, num_events
+
+
+def cmd_count(db, args):
+    args.item = None
+    if (args.field is None) != (args.value is None):
+        raise TrailDBError("--field and --value must be given together")
+    if args.value is not None:
+        args.field_id = resolve_field(db, args.field)
+        try:
+            args.item = db.get_item(args.field_id, args.value.encode())
+        except TrailDBError:
+            print('trails: 0')
+            print('events: 0')
+            return
+    num_trails = num_events = 0
+    for chunk_trails, chunk_events in scan(db, args, count_chunk):
+        num_trails += chunk_trails
+        num_events += chunk_events
+    print('trails: %d' % num_trails)
+    print('events: %d' % num_events)
+
+
+# top
+
+def top_chunk(db, args, start, end):
+    field = args.field_id
+    counts = SpaceSaving(args.capacity) if args.capacity else Counter()
+    for i in trail_ids(db, args, start, end):
+        trail = Counter(event[field] for event in events(db, args, i))
+        for item, n in trail.items():
+            if tdb_item_val(item):
+                if args.trails:
+                    n = 1
+                if args.capacity:
+                    counts.add(item, n)
+                else:
+                    counts[item] += n
+    return counts
+
+
+def cmd_top(db, args):
+    args.field_id = resolve_field(db, args.field)
+    if args.capacity:
+        counts = SpaceSaving(args.capacity)
+        for chunk in scan(db, args, top_chunk):
+            counts.merge(chunk)
+        top = [(item, n) for item, n, _ in counts.top(args.k)]
+    else:
+        counts = Counter()
+        for chunk in scan(db, args, top_chunk):
+            counts.update(chunk)
+        top = counts.most_common(args.k)
+    writer = csv.writer(sys.stdout, delimiter='\t', lineterminator='\n')
+    for item, n in top:
+        writer.writerow([text(db.get_item_value(item)), n])
+
+
+# merge
+
+def cmd_merge(db, args):
+    fields = field_names(db)
+    cons = TrailDBConstructor(args.output, fields[1:])
+    cons.append(db)
+    for path in args.inputs:
+        other = TrailDB(path)
+        if field_names(other) != fields:
+            raise TrailDBError("Fields of %s do not match %s" % (path, args.path))
+        cons.append(other)
+    cons.finalize()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m traildb',
+                                     description='Inspect TrailDBs.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes (default: 1)')
+
+    scan_opts = argparse.ArgumentParser(add_help=False)
+    scan_opts.add_argument('--start', type=parse_time,
+                           help='skip events before this time (inclusive)')
+    scan_opts.add_argument('--end', type=parse_time,
+                           help='skip events after this time (inclusive)')
+    scan_opts.add_argument('--sample', type=float, default=1.0,
+                           help='fraction of trails to scan, sampled by UUID')
+
+    cmd = commands.add_parser('info',
+                              help='print metadata and lexicon sizes')
+    cmd.add_argument('path')
+    cmd.set_defaults(fun=cmd_info)
+
+    cmd = commands.add_parser('dump', parents=[common, scan_opts],
+                              help='print events as CSV or JSON lines')
+    cmd.add_argument('path')
+    cmd.add_argument('--fields', help='comma-separated fields to output')
+    cmd.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    cmd.set_defaults(fun=cmd_dump)
+
+    cmd = commands.add_parser('count', parents=[common, scan_opts],
+                              help='count trails and events')
+    cmd.add_argument('path')
+    cmd.add_argument('--field', help='field to filter on, requires --value')
+    cmd.add_argument('--value', help='count only events with this value')
+    cmd.set_defaults(fun=cmd_count)
+
+    cmd = commands.add_parser('top', parents=[common, scan_opts],
+                              help='print the most frequent values of a field')
+    cmd.add_argument('path')
+    cmd.add_argument('field')
+    cmd.add_argument('-k', type=int, default=10,
+                     help='number of values to print (default: 10)')
+    cmd.add_argument('--trails', action='store_true',
+                     help='count trails instead of events')
+    cmd.add_argument('--capacity', type=int,
+                     help='approximate with this many counters per worker')
+    cmd.set_defaults(fun=cmd_top)
+
+    cmd = commands.add_parser('merge',
+                              help='merge TrailDBs into a new TrailDB')
+    cmd.add_argument('output', help='output path (without .tdb)')
+    cmd.add_argument('path')
+    cmd.add_argument('inputs', nargs='*')
+    cmd.set_defaults(fun=cmd_merge)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        args.fun(TrailDB(args.path), args)
+    except TrailDBError as e:
+        sys.stderr.write('error: %s\n' % e)
+        return 1
+    return 0
+
 
-for cookie, trail in traildb.TrailDB(*(sys.argv[1:] or ['a.tdb'])).crumbs():
-    print(cookie, trail)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""Query a directory of TrailDB shards."""
+import glob
+import pickle
+import traceback
+from collections import namedtuple
+from datetime import datetime
+from multiprocessing import Pool
+
+from .traildb import TrailDB, _TimeConverter
+
+ShardInfo = namedtuple('ShardInfo', ['path', 'time_range', 'num_trails',
+                                     'num_events', 'fields'])
+
+QueryResult = namedtuple('QueryResult', ['result', 'failures'])
+
+
+def _run_shard(args):
+    """Run a query on a single shard.
+
+    Returns (path, ok, value) where value is the traceback on failure.
+    In a worker process (check_pickle set), results that cannot be
+    pickled back to the parent are reported as failures too.
+    """
+    fun, path, check_pickle = args
+    try:
+        value = fun(TrailDB(path))
+        if check_pickle:
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return path, True, value
+    except Exception:
+        return path, False, traceback.format_exc()
+
+
+class TrailDBCollection(object):
+    """Scatter-gather queries over a set of TrailDBs.
+
+    Attributes:
+
+    TrailDBCollection.shards -- list of ShardInfo, sorted by path
+    TrailDBCollection.num_trails -- total number of trails
+    TrailDBCollection.num_events -- total number of events
+    """
+
+    def __init__(self, pattern):
+        """Index all TrailDBs matching a glob pattern, e.g. 'logs/*.tdb'."""
+        self.shards = [self._index(path) for path in sorted(glob.glob(pattern))]
+        self.num_trails = sum(shard.num_trails for shard in self.shards)
+        self.num_events = sum(shard.num_events for shard in self.shards)
+
+    def __len__(self):
+        """Return the number of shards."""
+        return len(self.shards)
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    @staticmethod
+    def _index(path):
+        db = TrailDB(path)
+        return ShardInfo(path, db.time_range(), db.num_trails,
+                         db.num_events, tuple(db.fields))
+
+    def time_range(self):
+        """Return the time range covered by all shards."""
+        if not self.shards:
+            return None
+        return (min(shard.time_range[0] for shard in self.shards),
+                max(shard.time_range[1] for shard in self.shards))
+
+    def select(self, start=None, end=None, fields=()):
+        """Return shards that may contain events in the given time range
+        and that have all the given fields.
+
+        start=None -- Minimum timestamp (integer or datetime), inclusive.
+        end=None -- Maximum timestamp (integer or datetime), inclusive.
+        fields=() -- Field names that must exist in the shard.
+        """
+        converter = _TimeConverter()
+        if isinstance(start, datetime):
+            start = converter.to_timestamp(start)
+        if isinstance(end, datetime):
+            end = converter.to_timestamp(end)
+        return [shard for shard in self.shards
+                if (start is None or shard.time_range[1] >= start) and
+                   (end is None or shard.time_range[0] <= end) and
+                   all(field in shard.fields for field in fields)]
+
+    def query(self, fun, combine=None, initial=None, start=None, end=None,
+              fields=(), processes=None, progress=None):
+        """Run a function on every selected shard and combine the results.
+
+        Shards are selected with select(start, end, fields) and fun is
+        called with an open TrailDB for each of them, in a pool of
+        worker processes. fun must be picklable, i.e. a module-level
+        function.
+
+        combine=None -- Function combine(accumulated, result) merging a
+                        shard result into the accumulated value. By
+                        default, results are collected in a dictionary
+                        keyed by shard path.
+        initial=None -- Initial accumulated value for combine.
+        processes=None -- Number of worker processes, the number of
+                          CPUs by default. Use 1 to run in this process.
+        progress=None -- Function progress(path, done, total, error)
+                         called after each shard. error is None on
+                         success or the traceback string on failure.
+
+        Returns QueryResult(result, failures) where failures is a list
+        of (path, traceback) tuples for shards that raised an exception
+        or whose result (or fun itself) could not be pickled.
+        """
+        acc = {} if combine is None else initial
+        paths = [shard.path for shard in self.select(start, end, fields)]
+        failures = []
+        pool = None
+        if processes == 1:
+            results = map(_run_shard, [(fun, path, False) for path in paths])
+        else:
+            try:
+                pickle.dumps(fun, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                # fun cannot be sent to workers: every shard fails.
+                error = traceback.format_exc()
+                results = [(path, False, error) for path in paths]
+            else:
+                pool = Pool(processes)
+                results = pool.imap_unordered(_run_shard,
+                                              [(fun, path, True) for path in paths])
+        try:
+            for done, (path, ok, value) in enumerate(results, 1):
+                if ok:
+                    if combine is None:
+                        acc[path] = value
+                    else:
+                        acc = combine(acc, value)
+                else:
+                    failures.append((path, value))
+                if progress:
+                    progress(path, done, len(paths), None if ok else value)
+        except BaseException:
+            # Do not wait for the remaining shards on errors or Ctrl-C.
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return QueryResult(acc, failures)
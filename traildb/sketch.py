@@ -0,0 +1,207 @@
+"""Mergeable streaming sketches for approximate aggregations.
+
+HyperLogLog estimates the number of distinct keys and SpaceSaving
+tracks the most frequent keys, both in a fixed amount of memory.
+Sketches of the same size built over disjoint parts of the data can
+be merged, which allows scanning trail chunks in parallel.
+"""
+import heapq
+import math
+import struct
+import sys
+from hashlib import md5
+
+MASK64 = 0xffffffffffffffff
+
+
+def hash64(key):
+    """Return a 64-bit hash of an integer, bytes or string key.
+
+    Unlike the builtin hash(), the result is stable across processes,
+    so sketches built in different workers can be merged.
+    """
+    if isinstance(key, int):
+        # splitmix64 finalizer
+        x = (key + 0x9e3779b97f4a7c15) & MASK64
+        x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+        x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK64
+        return x ^ (x >> 31)
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return struct.unpack('<Q', md5(key).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct keys using 2**precision bytes."""
+
+    MIN_PRECISION = 4
+    MAX_PRECISION = 18
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision=12):
+        """Initialize an empty sketch.
+
+        precision -- Number of index bits, between 4 and 18. The
+                     standard error is about 1.04 / sqrt(2**precision).
+        """
+        if not self.MIN_PRECISION <= precision <= self.MAX_PRECISION:
+            raise ValueError("Precision must be between %d and %d" %
+                             (self.MIN_PRECISION, self.MAX_PRECISION))
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def __getstate__(self):
+        return self.precision, self.registers
+
+    def __setstate__(self, state):
+        self.precision, self.registers = state
+
+    @classmethod
+    def size_of(cls, precision):
+        """Return the memory used by a sketch of the given precision in
+        bytes, including the Python object overhead."""
+        sketch = cls(precision)
+        return sys.getsizeof(sketch) + sys.getsizeof(sketch.registers)
+
+    def add(self, key):
+        """Add a key (integer, bytes or string) to the sketch."""
+        self.add_hash(hash64(key))
+
+    def add_hash(self, h):
+        """Add a precomputed 64-bit hash to the sketch."""
+        p = self.precision
+        index = h >> (64 - p)
+        rest = (h << p) & MASK64
+        rank = 65 - p if rest == 0 else 65 - rest.bit_length()
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Merge another sketch of the same precision into this one."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches of different precision")
+        # Registers hold ranks below 128, so the byte-wise maximum can be
+        # computed on the registers as big integers: the high bit of each
+        # byte of ((a | 0x80) - b) is set exactly where a >= b.
+        n = len(self.registers)
+        high = int.from_bytes(b'\x80' * n, 'little')
+        a = int.from_bytes(self.registers, 'little')
+        b = int.from_bytes(other.registers, 'little')
+        mask = ((((a | high) - b) & high) >> 7) * 0xff
+        merged = (a & mask) | (b & ~mask)
+        self.registers = bytearray(merged.to_bytes(n, 'little'))
+        return self
+
+    def estimate(self):
+        """Return the estimated number of distinct keys."""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # Small range correction: linear counting
+            return m * math.log(float(m) / zeros)
+        return raw
+
+    def __len__(self):
+        return int(round(self.estimate()))
+
+
+class SpaceSaving(object):
+    """Track the most frequent keys using at most `capacity` counters."""
+
+    def __init__(self, capacity=1000):
+        """Initialize an empty sketch.
+
+        capacity -- Maximum number of counters. Any key more frequent
+                    than N / capacity is guaranteed to be tracked,
+                    where N is the total count added.
+        """
+        if capacity < 1:
+            raise ValueError("Capacity must be positive")
+        self.capacity = capacity
+        self.counters = {}
+        # Min-heap of (count, seq, key) entries. Entries whose count no
+        # longer matches the counter of their key are stale and skipped
+        # when popped; seq keeps keys themselves from being compared.
+        self._heap = []
+        self._seq = 0
+
+    def add(self, key, count=1):
+        """Add `count` occurrences of key to the sketch."""
+        counters = self.counters
+        counter = counters.get(key)
+        if counter is not None:
+            counter[0] += count
+        elif len(counters) < self.capacity:
+            counter = counters[key] = [count, 0]
+        else:
+            floor = self._pop_min()
+            counter = counters[key] = [floor + count, floor]
+        self._seq += 1
+        heapq.heappush(self._heap, (counter[0], self._seq, key))
+        if len(self._heap) > 4 * self.capacity:
+            self._reheap()
+
+    def _pop_min(self):
+        """Remove the least frequent key and return its count."""
+        counters = self.counters
+        while True:
+            count, _, key = heapq.heappop(self._heap)
+            counter = counters.get(key)
+            if counter is not None and counter[0] == count:
+                del counters[key]
+                return count
+
+    def _reheap(self):
+        """Rebuild the heap from the counters, dropping stale entries."""
+        self._heap = [(c[0], i, key) for i, (key, c)
+                      in enumerate(self.counters.items())]
+        heapq.heapify(self._heap)
+        self._seq = len(self._heap)
+
+    def update(self, counts):
+        """Add a mapping of keys to counts to the sketch."""
+        for key, count in counts.items():
+            self.add(key, count)
+
+    def merge(self, other):
+        """Merge another sketch into this one."""
+        def floor(sketch):
+            if len(sketch.counters) < sketch.capacity:
+                return 0
+            return min(c[0] for c in sketch.counters.values())
+
+        own_floor = floor(self)
+        other_floor = floor(other)
+        merged = {}
+        for key in set(self.counters) | set(other.counters):
+            a = self.counters.get(key, [own_floor, own_floor])
+            b = other.counters.get(key, [other_floor, other_floor])
+            merged[key] = [a[0] + b[0], a[1] + b[1]]
+        if len(merged) > self.capacity:
+            top = sorted(merged, key=lambda k: merged[k][0], reverse=True)
+            merged = dict((k, merged[k]) for k in top[:self.capacity])
+        self.counters = merged
+        self._reheap()
+        return self
+
+    def map_keys(self, fun):
+        """Return a copy of this sketch with every key replaced by fun(key)."""
+        sketch = SpaceSaving(self.capacity)
+        sketch.counters = dict((fun(key), list(c))
+                               for key, c in self.counters.items())
+        sketch._reheap()
+        return sketch
+
+    def top(self, k=None):
+        """Return a list of (key, count, error) tuples for the k most
+        frequent keys. The true count lies in [count - error, count]."""
+        items = sorted(self.counters.items(),
+                       key=lambda kv: kv[1][0],
+                       reverse=True)
+        return [(key, c[0], c[1]) for key, c in items[:k]]
+
+    def __len__(self):
+        return len(self.counters)
@@ -1,16 +1,21 @@
 import os
 import sys
 
-from collections import namedtuple, defaultdict
-from collections import Mapping
+from array import array
+from binascii import hexlify
+from collections import namedtuple, defaultdict, deque, Counter
 from ctypes import c_char, c_char_p, c_ubyte, c_int, c_void_p
 from ctypes import c_uint, c_uint8, c_uint32, c_uint64
 from ctypes import Structure
 from ctypes import CDLL, CFUNCTYPE, POINTER, pointer
 from ctypes import byref, cast, string_at, addressof
+from calendar import timegm
 from datetime import datetime
+from multiprocessing import Pool
 import time
 
+from .sketch import HyperLogLog, SpaceSaving, hash64
+
 if os.name == "posix" and sys.platform == "darwin":
     try:
         lib = CDLL('libtraildb.dylib')
@@ -83,7 +88,7 @@ api(lib.tdb_get_trail_length, [tdb_cursor], c_uint64)
 def uuid_hex(uuid):
     if isinstance(uuid, str):
         return uuid
-    return string_at(uuid, 16).encode('hex')
+    return hexlify(string_at(uuid, 16)).decode()
 
 def uuid_raw(uuid):
     if isinstance(uuid, str):
@@ -119,6 +124,74 @@ def tdb_item_val(item):
     else:
         return item >> 16
 
+class _TimeConverter(object):
+    """Convert datetime objects to integer timestamps.
+
+    Conversions of naive datetimes are memoized: per day for UTC and
+    other fixed-offset timezones, and per hour for local time and
+    timezones with DST, whose offset may change within a day.
+    """
+
+    MAX_CACHE = 1 << 16
+
+    def __init__(self, tz=None):
+        """tz -- tzinfo to use, or None for naive local time."""
+        self.tz = tz
+        offset = tz.utcoffset(None) if tz is not None else None
+        self.fixed = offset is not None
+        if self.fixed:
+            self.offset = offset.days * 86400 + offset.seconds
+        self._timestamps = {}
+
+    def to_timestamp(self, dt):
+        """Return an integer timestamp for a datetime object. Naive
+        datetimes are interpreted in the timezone of this converter."""
+        if dt.tzinfo is not None and dt.utcoffset() is not None:
+            return timegm(dt.utctimetuple())
+        cache = self._timestamps
+        if len(cache) > self.MAX_CACHE:
+            cache.clear()
+        if self.fixed:
+            day = dt.toordinal()
+            base = cache.get(day)
+            if base is None:
+                base = cache[day] = timegm(dt.date().timetuple()) - self.offset
+            return base + dt.hour * 3600 + dt.minute * 60 + dt.second
+        hour = (dt.toordinal(), dt.hour)
+        base = cache.get(hour)
+        if base is None:
+            start = dt.replace(minute=0, second=0, microsecond=0)
+            if self.tz is None:
+                base = int(time.mktime(start.timetuple()))
+            else:
+                base = timegm(start.replace(tzinfo=self.tz).utctimetuple())
+            cache[hour] = base
+        return base + dt.minute * 60 + dt.second
+
+# Approximate memory used by one entry of a dictionary of sketches keyed
+# by item: the integer key and its share of the hash table.
+SKETCH_ENTRY_SIZE = 100
+
+# Number of trail chunks per worker process when building sketches.
+SKETCH_CHUNKS_PER_PROCESS = 8
+
+def _imap_bounded(pool, fun, jobs, max_pending):
+    """Like Pool.imap, but with at most max_pending jobs submitted and
+    not yet consumed, so that results cannot pile up in the parent
+    faster than it handles them."""
+    pending = deque()
+    for job in jobs:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(fun, (job,)))
+    while pending:
+        yield pending.popleft().get()
+
+def _sketch_chunk(args):
+    """Build a sketch over a chunk of trails in a worker process."""
+    path, kind, field, param, start, end = args
+    return TrailDB(path)._sketch_range(kind, field, param, start, end)
+
 class TrailDBError(Exception):
     """TrailDB error condition."""
     pass
@@ -126,11 +199,13 @@ class TrailDBError(Exception):
 class TrailDBConstructor(object):
     """Construct a new TrailDB."""
 
-    def __init__(self, path, ofields=()):
+    def __init__(self, path, ofields=(), tz=None):
         """Initialize a new TrailDB constructor.
 
         path -- TrailDB output path (without .tdb).
         ofields -- List of field (names) in this TrailDB.
+        tz -- Timezone (tzinfo) of naive datetimes passed to add().
+              By default naive datetimes are in local time.
         """
         if not path:
             raise TrailDBError("Path is required")
@@ -146,6 +221,7 @@ class TrailDBConstructor(object):
 
         self.path = path.encode()
         self.ofields = ofields
+        self._time = _TimeConverter(tz)
 
     def __del__(self):
         if hasattr(self, '_cons'):
@@ -159,7 +235,7 @@ class TrailDBConstructor(object):
         values -- value of each field.
         """
         if isinstance(tstamp, datetime):
-            tstamp = int(time.mktime(tstamp.timetuple()))
+            tstamp = self._time.to_timestamp(tstamp)
         n = len(self.ofields)
         value_array = (c_char_p * n)(*[val.encode() for val in values])
         value_lengths = (c_uint64 * n)(*[len(v) for v in values])
@@ -201,10 +277,20 @@ class TrailDBCursor(object):
     returned by TrailDB.trail().
     """
 
-    def __init__(self, cursor, cls, valuefun, parsetime, only_timestamp):
+    def __init__(self, cursor, cls, valuefun, parsetime, only_timestamp,
+                 timefun=None):
+        """timefun -- Function converting integer timestamps when
+                      parsetime is set, datetime.fromtimestamp by default.
+
+        Events of a trail are sorted by time, so consecutive events in
+        the same second share one converted datetime: timefun is called
+        once per distinct second rather than once per event.
+        """
         self.cursor = cursor
         self.valuefun = valuefun
         self.parsetime = parsetime
+        self.timefun = timefun or datetime.fromtimestamp
+        self._last_timestamp = self._last_time = None
         self.cls = cls
         self.only_timestamp = only_timestamp
 
@@ -226,7 +312,10 @@ class TrailDBCursor(object):
 
         timestamp = event.contents.timestamp
         if self.parsetime:
-            timestamp = datetime.fromtimestamp(event.contents.timestamp)
+            if timestamp != self._last_timestamp:
+                self._last_timestamp = timestamp
+                self._last_time = self.timefun(timestamp)
+            timestamp = self._last_time
         if self.only_timestamp:
             return timestamp
         elif self.valuefun:
@@ -245,18 +334,23 @@ class TrailDB(object):
     """
 
     def __init__(self, path):
-        """Open a TrailDB at path."""
+        """Open a TrailDB at path (str or bytes)."""
         self._db = db = lib.tdb_init()
-        res = lib.tdb_open(self._db, path)
+        res = lib.tdb_open(self._db, path if isinstance(path, bytes) else path.encode())
         if res != 0:
             raise TrailDBError("Could not open %s, error code %d" % (path, res))
 
+        self.path = path
+
         self.num_trails = lib.tdb_num_trails(db)
         self.num_events = lib.tdb_num_events(db)
         self.num_fields = lib.tdb_num_fields(db)
         self.fields = [lib.tdb_get_field_name(db, i) for i in range(self.num_fields)]
+        if sys.version_info >= (3,):
+            self.fields = [name.decode() for name in self.fields]
         self._event_cls = namedtuple('event', self.fields, rename=True)
         self._uint64_ptr = pointer(c_uint64())
+        self._trail_lengths = None
 
     def __del__(self):
         if hasattr(self, '_db'):
@@ -287,24 +381,97 @@ class TrailDB(object):
         for i in range(len(self)):
             yield self.get_uuid(i), self.trail(i, **kwds)
 
-    def trail(self, i, parsetime=False, rawitems=False, only_timestamp=False):
+    def trail(self, i, parsetime=False, rawitems=False, only_timestamp=False,
+              tz=None):
         """Return a cursor over a single trail.
 
         i -- Trail ID.
         parsetime=False -- Return datetime objects instead of integer timestamps.
         rawitems=False -- Return integer items instead of string values.
         only_timestamp=False -- Return only timestamps, not event objects.
+        tz=None -- Timezone (tzinfo) of parsed datetimes. By default
+                   naive datetimes in local time are returned.
         """
         cursor = lib.tdb_cursor_new(self._db)
         if lib.tdb_get_trail(cursor, i) != 0:
             raise TrailDBError("Failed to create cursor")
 
         valuefun = None if rawitems else self.get_item_value
+        timefun = None
+        if tz is not None:
+            timefun = lambda tstamp: datetime.fromtimestamp(tstamp, tz)
         return TrailDBCursor(cursor,
                              self._event_cls,
                              valuefun,
                              parsetime,
-                             only_timestamp)
+                             only_timestamp,
+                             timefun)
+
+    def trail_timestamps(self, i, datetime64=False):
+        """Return the timestamps of a single trail as an array.
+
+        i -- Trail ID.
+        datetime64=False -- Return a numpy datetime64[s] array (in UTC)
+                            instead of an array of integers.
+        """
+        cursor = lib.tdb_cursor_new(self._db)
+        try:
+            if lib.tdb_get_trail(cursor, i) != 0:
+                raise TrailDBError("Failed to create cursor")
+            tstamps = array('Q')
+            event = lib.tdb_cursor_next(cursor)
+            while event:
+                tstamps.append(event.contents.timestamp)
+                event = lib.tdb_cursor_next(cursor)
+        finally:
+            lib.tdb_cursor_free(cursor)
+        if datetime64:
+            import numpy
+            return numpy.frombuffer(tstamps, dtype=numpy.uint64).astype('datetime64[s]')
+        return tstamps
+
+    def trail_lengths(self):
+        """Return an array of event counts, indexed by Trail ID.
+
+        The lengths are computed on the first call and cached for the
+        lifetime of this handle."""
+        if self._trail_lengths is None:
+            lengths = array('Q', [0]) * self.num_trails
+            cursor = lib.tdb_cursor_new(self._db)
+            try:
+                for i in range(self.num_trails):
+                    if lib.tdb_get_trail(cursor, i) != 0:
+                        raise TrailDBError("Failed to create cursor")
+                    lengths[i] = lib.tdb_get_trail_length(cursor)
+            finally:
+                lib.tdb_cursor_free(cursor)
+            self._trail_lengths = lengths
+        return self._trail_lengths
+
+    def partition(self, n):
+        """Split Trail IDs into at most n contiguous chunks with a
+        roughly equal number of events in each.
+
+        Returns a list of (start, end) tuples: each chunk covers
+        Trail IDs range(start, end).
+        """
+        if n < 1:
+            raise ValueError("Number of chunks must be positive")
+        if self.num_trails == 0:
+            return []
+        n = min(n, self.num_trails)
+        lengths = self.trail_lengths()
+        total = sum(lengths)
+        chunks = []
+        start = acc = 0
+        for i, length in enumerate(lengths):
+            acc += length
+            if len(chunks) < n - 1 and acc * n >= total * (len(chunks) + 1):
+                chunks.append((start, i + 1))
+                start = i + 1
+        if start < self.num_trails:
+            chunks.append((start, self.num_trails))
+        return chunks
 
     def field(self, fieldish):
         """Return a field ID given a field name."""
@@ -368,15 +535,16 @@ class TrailDB(object):
             raise IndexError("UUID '%s' not found" % uuid)
         return self._uint64_ptr.contents.value
 
-    def time_range(self, parsetime=False):
+    def time_range(self, parsetime=False, tz=None):
         """Return the time range covered by this TrailDB.
 
         parsetime=False -- Return time range as integers or datetime objects.
+        tz=None -- Timezone (tzinfo) of parsed datetimes, local time by default.
         """
         tmin = self.min_timestamp()
         tmax = self.max_timestamp()
         if parsetime:
-            return datetime.fromtimestamp(tmin), datetime.fromtimestamp(tmax)
+            return datetime.fromtimestamp(tmin, tz), datetime.fromtimestamp(tmax, tz)
         return tmin, tmax
 
     def min_timestamp(self):
@@ -386,3 +554,110 @@ class TrailDB(object):
     def max_timestamp(self):
         """Return the maximum time stamp of this TrailDB."""
         return lib.tdb_max_timestamp(self._db)
+
+    def approx_distinct(self, fieldish, precision=None, memory=1 << 24, processes=1):
+        """Return a dictionary mapping each value of the given field ID or
+        field name to a HyperLogLog sketch of the distinct trails
+        (UUIDs) containing the value. Values are byte strings, as
+        returned by get_item_value().
+
+        Sketches are keyed by UUID, so results from different TrailDBs
+        can be combined with HyperLogLog.merge().
+
+        precision=None -- HyperLogLog precision. By default, the highest
+                          precision that fits the memory budget.
+        memory=16MB -- Memory budget in bytes, including Python object
+                       overhead. With several processes, the parent
+                       holds the merged result plus up to `processes`
+                       chunk results, all within this budget. Raises
+                       TrailDBError if the field has too many values
+                       to fit in it.
+        processes=1 -- Number of worker processes to scan with.
+        """
+        field = self.field(fieldish)
+        num_values = max(1, self.lexicon_size(field) - 1)
+        copies = 1 if processes <= 1 else processes + 1
+        def usage(p):
+            return copies * num_values * (HyperLogLog.size_of(p) + SKETCH_ENTRY_SIZE)
+        if precision is None:
+            precision = HyperLogLog.MIN_PRECISION
+            while (precision < HyperLogLog.MAX_PRECISION and
+                   usage(precision + 1) <= memory):
+                precision += 1
+        if usage(precision) > memory:
+            raise TrailDBError("Memory budget of %d bytes is too small for %d "
+                               "values, %d bytes needed" %
+                               (memory, num_values, usage(precision)))
+        sketches = self._sketch('distinct', field, precision, processes)
+        return dict((self.get_item_value(item), sketch)
+                    for item, sketch in sketches.items())
+
+    def top_k_sketch(self, fieldish, capacity=1000, processes=1):
+        """Return a SpaceSaving sketch counting events per value of the
+        given field ID or field name, keyed by byte string values.
+        Empty values are not counted.
+
+        capacity=1000 -- Maximum number of counters per process.
+        processes=1 -- Number of worker processes to scan with.
+        """
+        sketch = self._sketch('top_k', self.field(fieldish), capacity, processes)
+        return sketch.map_keys(self.get_item_value)
+
+    def approx_top_k(self, fieldish, k, capacity=None, processes=1):
+        """Return a list of (value, count, error) tuples for the k most
+        frequent values of the given field ID or field name. Values are
+        byte strings.
+
+        capacity=None -- Number of counters to track, 10 * k but at
+                         least 100 by default.
+        processes=1 -- Number of worker processes to scan with.
+        """
+        capacity = capacity or max(10 * k, 100)
+        return self.top_k_sketch(fieldish, capacity, processes).top(k)
+
+    def _sketch(self, kind, field, param, processes):
+        if processes <= 1:
+            return self._sketch_range(kind, field, param, 0, self.num_trails)
+        chunks = self.partition(processes * SKETCH_CHUNKS_PER_PROCESS)
+        jobs = [(self.path, kind, field, param, start, end)
+                for start, end in chunks]
+        merged = SpaceSaving(param) if kind == 'top_k' else {}
+        pool = Pool(processes)
+        try:
+            # At most `processes` chunk results wait in the parent
+            # besides the merged result.
+            for part in _imap_bounded(pool, _sketch_chunk, jobs, processes):
+                if kind == 'top_k':
+                    merged.merge(part)
+                    continue
+                for item, sketch in part.items():
+                    if item in merged:
+                        merged[item].merge(sketch)
+                    else:
+                        merged[item] = sketch
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        return merged
+
+    def _sketch_range(self, kind, field, param, start, end):
+        if kind == 'top_k':
+            sketch = SpaceSaving(param)
+            for i in range(start, end):
+                counts = Counter(event[field]
+                                 for event in self.trail(i, rawitems=True))
+                sketch.update(dict((item, n) for item, n in counts.items()
+                                   if tdb_item_val(item)))
+            return sketch
+        sketches = {}
+        for i in range(start, end):
+            h = hash64(self.get_uuid(i, raw=True))
+            for item in set(event[field] for event in self.trail(i, rawitems=True)):
+                if tdb_item_val(item):
+                    if item not in sketches:
+                        sketches[item] = HyperLogLog(param)
+                    sketches[item].add_hash(h)
+        return sketches